@@ -1,27 +1,447 @@
 from argparse import ArgumentParser, Namespace
-from collections import defaultdict
-from json import load
-from os import environ
+from ast import literal_eval
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from cProfile import Profile
+from datetime import datetime
+from hashlib import sha256
+from json import dump, dumps, load, loads
+from os import environ, fdopen, makedirs, path, remove, replace
+import sqlite3
+from sys import stdout
+from tempfile import mkstemp
+from time import perf_counter, process_time, sleep, time
+import tracemalloc
 from ytmusicapi import OAuthCredentials, YTMusic, setup_oauth
 import requests
 from typing import Literal
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient import discovery
+from googleapiclient.http import HttpRequest
 from google_auth_oauthlib.flow import InstalledAppFlow
 
 
 AUTH: Literal["browser", "oauth"] | None = None
 MAX_RESULTS = 50
 SCOPES = ["https://www.googleapis.com/auth/youtube"]
+# videos per YTMusic playlist edit call
+BULK_CHUNK = 200
+# quota units and rough latency per call, for sort planning
+YOUTUBE_WRITE_UNITS = 50
+YOUTUBE_CALL_SECONDS = 0.5
+YTMUSIC_CALL_SECONDS = 1.5
+# Tracks per get_watch_playlist request
+WATCH_PLAYLIST_PAGE = 25
+QUOTA_BUDGET = 10000
+CLEAN_MAP_FILE = "clean_map.json"
+TOKEN_CACHE_DIR = ".tokens"
+LIBRARY_FILE = "library.db"
+UNCLEANABLE_RETRY_DAYS = 7
+
+
+def write_json(file_path, data):
+    """
+    Atomically replace file_path with data as JSON.
+    The temporary file is unique per writer and only readable by the owner.
+    """
+    temp_fd, temp_path = mkstemp(
+        dir=path.dirname(path.abspath(file_path)), suffix=".tmp"
+    )
+    try:
+        with fdopen(temp_fd, "w") as temp_file:
+            dump(data, temp_file)
+        replace(temp_path, file_path)
+    except BaseException:
+        remove(temp_path)
+        raise
+
+
+class Profiler:
+    """
+    Records wall time, CPU time, API requests and peak traced memory for
+    named phases (fetch, enrich, match, plan, mutate, report).
+    Times and requests are self values, excluding nested spans.
+    Spans are no-ops until enabled, and a span nested inside another span
+    of the same name is only counted once.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = perf_counter()
+        self.stack = []
+        self.events = []
+
+    def enable(self):
+        self.enabled = True
+        self.started = perf_counter()
+        tracemalloc.start()
+
+    def count_request(self, *_, **__):
+        """Count an API request against the innermost span."""
+        if self.stack:
+            self.stack[-1]["requests"] += 1
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled or any(frame["name"] == name for frame in self.stack):
+            yield
+            return
+
+        # Keep the parent's peak before resetting it for this span
+        if self.stack:
+            self.stack[-1]["peak"] = max(
+                self.stack[-1]["peak"], tracemalloc.get_traced_memory()[1]
+            )
+        frame = {"name": name, "peak": 0, "requests": 0, "wall": 0.0, "cpu": 0.0}
+        self.stack.append(frame)
+        tracemalloc.reset_peak()
+        wall_start, cpu_start = perf_counter(), process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = perf_counter() - wall_start, process_time() - cpu_start
+            self.stack.pop()
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            if self.stack:
+                # The parent's self time excludes this span
+                self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+                self.stack[-1]["wall"] += wall
+                self.stack[-1]["cpu"] += cpu
+            self.events.append(
+                {
+                    "name": name,
+                    "parent": self.stack[-1]["name"] if self.stack else None,
+                    "start": wall_start - self.started,
+                    "wall": wall,
+                    "cpu": cpu,
+                    "self_wall": wall - frame["wall"],
+                    "self_cpu": cpu - frame["cpu"],
+                    "requests": frame["requests"],
+                    "peak_memory": peak,
+                }
+            )
+
+    def summary(self):
+        phases = {}
+        for event in self.events:
+            phase = phases.setdefault(
+                event["name"],
+                {"phase": event["name"], "requests": 0, "wall": 0.0, "cpu": 0.0},
+            )
+            phase["requests"] += event["requests"]
+            phase["wall"] += event["self_wall"]
+            phase["cpu"] += event["self_cpu"]
+            phase["peak_memory"] = max(
+                phase.get("peak_memory", 0), event["peak_memory"]
+            )
+        return sorted(phases.values(), key=lambda phase: -phase["wall"])
+
+    def write(self, path):
+        with open(path, "w") as trace_file:
+            dump({"phases": self.summary(), "events": self.events}, trace_file)
+
+    def md_table(self):
+        return YTPlaylists.create_md_table(
+            "Phase breakdown",
+            ("phase", "requests", "wall", "cpu", "peakMemory"),
+            [
+                {
+                    "phase": phase["phase"],
+                    "requests": str(phase["requests"]),
+                    "wall": f"{phase['wall']:.2f}s",
+                    "cpu": f"{phase['cpu']:.2f}s",
+                    "peakMemory": f"{phase['peak_memory'] / 2**20:.1f} MiB",
+                }
+                for phase in self.summary()
+            ],
+        )
+
+
+PROFILER = Profiler()
+
+
+class CountedHttpRequest(HttpRequest):
+    """YouTube request that counts itself against the current span."""
+
+    def execute(self, *args, **kwargs):
+        PROFILER.count_request()
+        return super().execute(*args, **kwargs)
+
+
+class TokenStore:
+    """
+    Local cache of OAuth access tokens, shared by every process and
+    subcommand run from the same directory, so that only an expired
+    access token triggers a refresh. The directory is only accessible
+    by the owner and every file in it is written with mode 0600.
+    """
+
+    def __init__(self, directory=TOKEN_CACHE_DIR):
+        self.directory = directory
+        makedirs(directory, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def parse_token(token):
+        # Accept JSON as well as a Python dict literal
+        try:
+            return loads(token)
+        except ValueError:
+            return literal_eval(token)
+
+    def read(self, name):
+        try:
+            with open(path.join(self.directory, name), "r") as token_file:
+                return load(token_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write(self, name, token):
+        write_json(path.join(self.directory, name), token)
+
+    def youtube_credentials(self, youtube_token):
+        info = self.parse_token(youtube_token)
+        # youtube.json only keeps a fingerprint of the refresh token
+        fingerprint = sha256(info["refresh_token"].encode()).hexdigest()
+        cached = self.read("youtube.json")
+        if cached.get("fingerprint") == fingerprint:
+            info |= {"token": cached["token"], "expiry": cached["expiry"]}
+
+        credentials = Credentials.from_authorized_user_info(info, SCOPES)
+        if not credentials.valid:
+            credentials.refresh(Request())
+            self.write(
+                "youtube.json",
+                {
+                    "fingerprint": fingerprint,
+                    "token": credentials.token,
+                    "expiry": credentials.expiry.isoformat() + "Z",
+                },
+            )
+        return credentials
+
+    def ytmusic_auth(self, access_token, refresh_token):
+        """
+        Path of the YTMusic OAuth token. YTMusic refreshes the access token
+        when it expires and writes it back to the same file, so unlike
+        youtube.json this file has to hold the refresh token itself.
+        """
+        if self.read("ytmusic.json").get("refresh_token") != refresh_token:
+            self.write(
+                "ytmusic.json",
+                {
+                    "scope": SCOPES[0],
+                    "token_type": "Bearer",
+                    "access_token": access_token,
+                    "refresh_token": refresh_token,
+                },
+            )
+        return path.join(self.directory, "ytmusic.json")
+
+
+# key(playlist item, YTMusic track) for sort_playlist
+SORT_KEYS = {
+    "title": lambda item, _: item["snippet"]["title"].upper(),
+    "artist": lambda item, track: (
+        ", ".join(artist["name"] for artist in track.get("artists") or []).upper(),
+        item["snippet"]["title"].upper(),
+    ),
+    "album": lambda item, track: (
+        ((track.get("album") or {}).get("name") or "").upper(),
+        item["snippet"]["title"].upper(),
+    ),
+    "duration": lambda item, track: (
+        track.get("duration_seconds", 0),
+        item["snippet"]["title"].upper(),
+    ),
+}
+
+
+class LibraryIndex:
+    """
+    Local SQLite copy of playlists, their memberships and per-video details,
+    populated by get_tracks, so that compare, problems and cross-playlist
+    queries can run offline.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS playlists (
+            title TEXT PRIMARY KEY,
+            playlist_id TEXT,
+            fetched_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS memberships (
+            playlist_title TEXT NOT NULL,
+            video_id TEXT NOT NULL,
+            position INTEGER,
+            track TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS videos (
+            video_id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            title_link TEXT NOT NULL,
+            sanitized_title TEXT NOT NULL,
+            artist_id TEXT,
+            artist_names TEXT NOT NULL,
+            duration_seconds INTEGER,
+            is_available INTEGER,
+            like_status TEXT,
+            privacy_status TEXT,
+            video_type TEXT
+        );
+        CREATE INDEX IF NOT EXISTS memberships_playlist_title
+            ON memberships(playlist_title);
+        CREATE INDEX IF NOT EXISTS memberships_video_id ON memberships(video_id);
+        CREATE INDEX IF NOT EXISTS videos_sanitized_title ON videos(sanitized_title);
+        CREATE INDEX IF NOT EXISTS videos_artist_id ON videos(artist_id);
+    """
+
+    def __init__(self, file_path=LIBRARY_FILE):
+        self.connection = sqlite3.connect(file_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(self.SCHEMA)
+
+    def record(self, playlist_title, playlist_id, tracks):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM memberships WHERE playlist_title = ?", (playlist_title,)
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO playlists VALUES (?, ?, ?)",
+                (playlist_title, playlist_id, time()),
+            )
+            self.connection.executemany(
+                "INSERT INTO memberships VALUES (?, ?, ?, ?)",
+                (
+                    (
+                        playlist_title,
+                        track["videoId"],
+                        track["youtube"].get("snippet", {}).get("position"),
+                        dumps(track),
+                    )
+                    for track in tracks
+                ),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        track["videoId"],
+                        track["title"],
+                        track["titleLink"],
+                        YTPlaylists.sanitize_track_title(track["title"]),
+                        track["artists"][0].get("id") if track["artists"] else None,
+                        track["artistNames"],
+                        track["duration_seconds"],
+                        track["isAvailable"],
+                        track["likeStatus"],
+                        track["privacyStatus"],
+                        track["videoType"],
+                    )
+                    for track in tracks
+                ),
+            )
+
+    def forget(self, playlist_title):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM memberships WHERE playlist_title = ?", (playlist_title,)
+            )
+            self.connection.execute(
+                "DELETE FROM playlists WHERE title = ?", (playlist_title,)
+            )
+
+    def get_tracks(self, playlist_title):
+        if self.fetched_at(playlist_title) is None:
+            raise LookupError(f"{playlist_title} is not in the library")
+        return [
+            loads(row["track"])
+            for row in self.connection.execute(
+                "SELECT track FROM memberships WHERE playlist_title = ? ORDER BY rowid",
+                (playlist_title,),
+            )
+        ]
+
+    def fetched_at(self, playlist_title):
+        row = self.connection.execute(
+            "SELECT fetched_at FROM playlists WHERE title = ?", (playlist_title,)
+        ).fetchone()
+        return row and row["fetched_at"]
+
+    def freshness(self, playlist_title):
+        fetched_at = self.fetched_at(playlist_title)
+        if fetched_at is None:
+            return f"{playlist_title}: not in the library"
+        return (
+            f"{playlist_title}: fetched {datetime.fromtimestamp(fetched_at):%Y-%m-%d %H:%M}"
+            f" ({(time() - fetched_at) / 3600:.1f} hours ago)"
+        )
+
+    def get_tracks_in_playlists(self, min_playlists):
+        return [
+            dict(row)
+            for row in self.connection.execute(
+                """
+                SELECT videos.*,
+                    COUNT(DISTINCT playlist_title) AS playlist_count,
+                    GROUP_CONCAT(DISTINCT playlist_title) AS playlist_titles
+                FROM memberships JOIN videos USING (video_id)
+                GROUP BY video_id
+                HAVING playlist_count >= ?
+                ORDER BY playlist_count DESC, sanitized_title
+                """,
+                (min_playlists,),
+            )
+        ]
+
+    def get_duplicates(self):
+        return [dict(row) for row in self.connection.execute("""
+                SELECT videos.*, GROUP_CONCAT(DISTINCT playlist_title) AS playlist_titles
+                FROM videos JOIN memberships USING (video_id)
+                WHERE sanitized_title IN (
+                    SELECT sanitized_title FROM videos
+                    WHERE video_id IN (SELECT video_id FROM memberships)
+                    GROUP BY sanitized_title HAVING COUNT(*) > 1
+                )
+                GROUP BY video_id
+                ORDER BY sanitized_title
+                """)]
 
 
 class YTPlaylists:
 
-    def __init__(self):
-        credentials = Credentials.from_authorized_user_info(
-            eval(environ["youtube_token"]), SCOPES
+    def __init__(
+        self, library: LibraryIndex | None = None, offline=False, liked_songs=False
+    ):
+        # get_song results and YTMusic playlist tracks by videoId,
+        # kept warm between watch cycles
+        self.songs = {}
+        self.ytmusic_tracks = {}
+
+        # get_album_catalog results by album browseId
+        self.album_catalogs = {}
+
+        # get_counterparts results by videoId
+        self.counterparts = {}
+
+        # Resolve likeStatus from the liked songs, fetched once per session
+        self.liked_songs = liked_songs
+        self.liked_video_ids = None
+
+        # Offline instances only read tracks from the library
+        self.library = library
+        self.offline = offline
+        if offline:
+            return
+
+        token_store = TokenStore()
+        credentials = token_store.youtube_credentials(environ["youtube_token"])
+        self.youtube = discovery.build(
+            "youtube",
+            "v3",
+            credentials=credentials,
+            requestBuilder=CountedHttpRequest,
         )
-        self.youtube = discovery.build("youtube", "v3", credentials=credentials)
 
         match AUTH:
             case "browser":
@@ -32,12 +452,9 @@ class YTPlaylists:
                 self.ytmusic = YTMusic(browser_json)
             case "oauth":
                 self.ytmusic = YTMusic(
-                    auth={
-                        "scope": SCOPES[0],
-                        "token_type": "Bearer",
-                        "access_token": environ["access_token"],
-                        "refresh_token": environ["refresh_token"],
-                    },
+                    auth=token_store.ytmusic_auth(
+                        environ["access_token"], environ["refresh_token"]
+                    ),
                     oauth_credentials=OAuthCredentials(
                         client_id=environ["client_id"],
                         client_secret=environ["client_secret"],
@@ -47,21 +464,56 @@ class YTPlaylists:
                 )
             case _:
                 self.ytmusic = YTMusic()
+        self.ytmusic._session.hooks["response"].append(PROFILER.count_request)
+
+    def clear_caches(self):
+        self.songs = {}
+        self.ytmusic_tracks = {}
+        self.album_catalogs = {}
+        self.counterparts = {}
+        self.liked_video_ids = None
 
     @staticmethod
     def fetch_all(method, **kwargs):
-        all_items = []
-        next_page_token = None
-        while True:
-            results = method(
-                maxResults=MAX_RESULTS,
-                pageToken=next_page_token,
-                **kwargs,
-            ).execute()
-            all_items.extend(results["items"])
-            next_page_token = results.get("nextPageToken")
-            if not next_page_token:
-                return all_items
+        with PROFILER.span("fetch"):
+            all_items = []
+            next_page_token = None
+            while True:
+                results = method(
+                    maxResults=MAX_RESULTS,
+                    pageToken=next_page_token,
+                    **kwargs,
+                ).execute()
+                all_items.extend(results["items"])
+                next_page_token = results.get("nextPageToken")
+                if not next_page_token:
+                    return all_items
+
+    def execute_batch(self, batch_requests):
+        """
+        Execute (request_id, request) pairs as batched HTTP requests.
+        Calls within a batch may run in any order.
+        Returns a dict of request_id to the exception it raised.
+        If a whole batch fails, every request in it is reported as failed.
+        """
+        errors = {}
+
+        def callback(request_id, _, exception):
+            if exception is not None:
+                errors[request_id] = exception
+
+        for i in range(0, len(batch_requests), MAX_RESULTS):
+            batch = self.youtube.new_batch_http_request(callback=callback)
+            chunk = batch_requests[i : i + MAX_RESULTS]
+            for request_id, request in chunk:
+                batch.add(request, request_id=request_id)
+            try:
+                PROFILER.count_request()
+                batch.execute()
+            except Exception as e:
+                for request_id, _ in chunk:
+                    errors.setdefault(request_id, e)
+        return errors
 
     @staticmethod
     def create_md_table(table_name, headers, records):
@@ -87,6 +539,40 @@ class YTPlaylists:
         }
         return playlist_title_id.get(playlist_title)
 
+    def get_playlist_signatures(self, playlist_titles):
+        """
+        Cheap change detection for watch mode.
+        Combines the playlist etag and item count with the etag of the
+        first page of items, at one quota unit per call.
+        """
+        playlists = self.fetch_all(
+            self.youtube.playlists().list,
+            part="contentDetails,id,snippet",
+            mine=True,
+        )
+        signatures = {}
+        for playlist in playlists:
+            playlist_title = playlist["snippet"]["title"]
+            if playlist_title not in playlist_titles:
+                continue
+            with PROFILER.span("fetch"):
+                first_page = (
+                    self.youtube.playlistItems()
+                    .list(playlistId=playlist["id"], part="id", maxResults=MAX_RESULTS)
+                    .execute()
+                )
+            signatures[playlist_title] = (
+                playlist["etag"],
+                playlist["contentDetails"]["itemCount"],
+                first_page["etag"],
+            )
+        return signatures
+
+    def invalidate(self, playlist_title):
+        # The library copy is stale once a playlist is mutated
+        if self.library:
+            self.library.forget(playlist_title)
+
     def delete_playlist(self, playlist_title):
         playlist_id = self.get_playlist_id(playlist_title)
         if playlist_id:
@@ -104,83 +590,157 @@ class YTPlaylists:
         playlist_id = self.get_playlist_id(from_playlist_title)
         self.ytmusic.edit_playlist(playlistId=playlist_id, title=to_playlist_title)
 
-    def clear_playlist(self, playlist_title):
-        playlist_id = self.get_playlist_id(playlist_title)
-        if not playlist_id:
-            return
-
-        # Get all playlist items using YouTube API
-        playlist_items = self.fetch_all(
-            self.youtube.playlistItems().list,
-            playlistId=playlist_id,
-            part="id",
-        )
+    @property
+    def bulk_mutations(self):
+        # YTMusic can only edit playlists when authenticated
+        return AUTH is not None
 
-        # Delete each item
-        for item in playlist_items:
-            self.youtube.playlistItems().delete(id=item["id"]).execute()
+    def add_playlist_items(self, playlist_id, video_ids):
+        """
+        Append videos in order. Uses YTMusic calls of BULK_CHUNK videos
+        when possible and one YouTube insert per video otherwise.
+        Returns the videoIds that could not be added.
+        """
+        if self.bulk_mutations:
+            for i in range(0, len(video_ids), BULK_CHUNK):
+                try:
+                    response = self.ytmusic.add_playlist_items(
+                        playlist_id, video_ids[i : i + BULK_CHUNK], duplicates=True
+                    )
+                except Exception as e:
+                    response = {"status": str(e)}
+                if "SUCCEEDED" not in response.get("status", ""):
+                    # Keep the order by adding the rest one by one
+                    video_ids = video_ids[i:]
+                    break
+            else:
+                return []
 
-    def overwrite_playlist(self, target_playlist_title, archive_playlist_title, tracks):
-        archive_playlist_id = self.get_playlist_id(archive_playlist_title)
-        if archive_playlist_id:
-            self.clear_playlist(archive_playlist_title)
-        else:
-            # Create archive playlist using YouTube API
-            response = (
-                self.youtube.playlists()
-                .insert(
-                    part="snippet,status",
+        failed_video_ids = []
+        for video_id in video_ids:
+            try:
+                self.youtube.playlistItems().insert(
+                    part="snippet",
                     body={
                         "snippet": {
-                            "title": archive_playlist_title,
-                            "description": "",
-                        },
-                        "status": {"privacyStatus": "public"},
+                            "playlistId": playlist_id,
+                            "resourceId": {
+                                "kind": "youtube#video",
+                                "videoId": video_id,
+                            },
+                        }
                     },
-                )
-                .execute()
+                ).execute()
+            except Exception as e:
+                failed_video_ids.append(video_id)
+                print(f"Error adding {video_id}: {str(e)}")
+        return failed_video_ids
+
+    def clear_playlist(self, playlist_title):
+        with PROFILER.span("mutate"):
+            playlist_id = self.get_playlist_id(playlist_title)
+            if not playlist_id:
+                return
+
+            if self.bulk_mutations:
+                tracks = [
+                    track
+                    for track in self.ytmusic.get_playlist(playlist_id, None)["tracks"]
+                    if track.get("videoId") and track.get("setVideoId")
+                ]
+                # Whatever a failed chunk leaves is deleted through YouTube
+                for i in range(0, len(tracks), BULK_CHUNK):
+                    try:
+                        self.ytmusic.remove_playlist_items(
+                            playlist_id, tracks[i : i + BULK_CHUNK]
+                        )
+                    except Exception as e:
+                        print(f"Error clearing {playlist_title}: {str(e)}")
+
+            # Get all (remaining) playlist items using YouTube API
+            playlist_items = self.fetch_all(
+                self.youtube.playlistItems().list,
+                playlistId=playlist_id,
+                part="id",
             )
-            archive_playlist_id = response["id"]
 
-        target_playlist_id = self.get_playlist_id(target_playlist_title)
+            # Delete each item, some may already be gone after the YTMusic calls
+            for item in playlist_items:
+                try:
+                    self.youtube.playlistItems().delete(id=item["id"]).execute()
+                except Exception as e:
+                    print(f"Error clearing {playlist_title}: {str(e)}")
 
-        # Copy all items from target to archive using YouTube API
-        target_items = self.fetch_all(
-            self.youtube.playlistItems().list,
-            playlistId=target_playlist_id,
-            part="snippet",
-        )
-        for item in target_items:
-            self.youtube.playlistItems().insert(
-                part="snippet",
-                body={
-                    "snippet": {
-                        "playlistId": archive_playlist_id,
-                        "resourceId": {
-                            "kind": "youtube#video",
-                            "videoId": item["snippet"]["resourceId"]["videoId"],
+    def overwrite_playlist(self, target_playlist_title, archive_playlist_title, tracks):
+        self.invalidate(target_playlist_title)
+        self.invalidate(archive_playlist_title)
+        with PROFILER.span("mutate"):
+            target_playlist_id = self.get_playlist_id(target_playlist_title)
+            archive_playlist_id = self.get_playlist_id(archive_playlist_title)
+            archived = False
+            if archive_playlist_id:
+                self.clear_playlist(archive_playlist_title)
+            elif self.bulk_mutations:
+                # Create the archive as a copy of the target in one call
+                try:
+                    response = self.ytmusic.create_playlist(
+                        archive_playlist_title,
+                        "",
+                        "PUBLIC",
+                        source_playlist=target_playlist_id,
+                    )
+                except Exception as e:
+                    print(f"Error copying {target_playlist_title}: {str(e)}")
+                    response = None
+                if isinstance(response, str):
+                    archive_playlist_id = response
+                    archived = True
+
+            if not archive_playlist_id:
+                # Create archive playlist using YouTube API
+                response = (
+                    self.youtube.playlists()
+                    .insert(
+                        part="snippet,status",
+                        body={
+                            "snippet": {
+                                "title": archive_playlist_title,
+                                "description": "",
+                            },
+                            "status": {"privacyStatus": "public"},
                         },
-                    }
-                },
-            ).execute()
+                    )
+                    .execute()
+                )
+                archive_playlist_id = response["id"]
 
-        # Clear target playlist
-        self.clear_playlist(target_playlist_title)
+            # Copy all items from target to archive
+            if not archived and self.bulk_mutations:
+                try:
+                    response = self.ytmusic.add_playlist_items(
+                        archive_playlist_id, source_playlist=target_playlist_id
+                    )
+                except Exception as e:
+                    response = {"status": str(e)}
+                archived = "SUCCEEDED" in response.get("status", "")
+            if not archived:
+                target_items = self.fetch_all(
+                    self.youtube.playlistItems().list,
+                    playlistId=target_playlist_id,
+                    part="snippet",
+                )
+                self.add_playlist_items(
+                    archive_playlist_id,
+                    [item["snippet"]["resourceId"]["videoId"] for item in target_items],
+                )
 
-        # Add sorted tracks to target playlist using YouTube API
-        for track in tracks:
-            self.youtube.playlistItems().insert(
-                part="snippet",
-                body={
-                    "snippet": {
-                        "playlistId": target_playlist_id,
-                        "resourceId": {
-                            "kind": "youtube#video",
-                            "videoId": track["videoId"],
-                        },
-                    }
-                },
-            ).execute()
+            # Clear target playlist
+            self.clear_playlist(target_playlist_title)
+
+            # Add sorted tracks to target playlist
+            self.add_playlist_items(
+                target_playlist_id, [track["videoId"] for track in tracks]
+            )
 
     @staticmethod
     def get_track_details(track):
@@ -208,124 +768,263 @@ class YTPlaylists:
         }
         return details
 
-    def get_tracks(self, playlist_title):
-        playlist_id = self.get_playlist_id(playlist_title)
-        tracks_from_ytmusic = self.ytmusic.get_playlist(playlist_id, None)["tracks"]
-        tracks_from_youtube = self.fetch_all(
+    def get_liked_video_ids(self):
+        if self.liked_video_ids is None:
+            with PROFILER.span("fetch"):
+                if AUTH is not None:
+                    tracks = self.ytmusic.get_liked_songs(None)["tracks"]
+                    self.liked_video_ids = {track["videoId"] for track in tracks}
+                else:
+                    items = self.fetch_all(
+                        self.youtube.playlistItems().list,
+                        playlistId="LL",
+                        part="contentDetails",
+                    )
+                    self.liked_video_ids = {
+                        item["contentDetails"]["videoId"] for item in items
+                    }
+        return self.liked_video_ids
+
+    def get_counterparts(self, playlist_id, video_ids, playlist_length):
+        """
+        YTMusic song counterparts (audio tracks) of music videos, by videoId.
+        When more videos are missing than the whole playlist takes pages,
+        one watch playlist of the whole playlist covers most of them.
+        The rest get a watch playlist of their own. Results, including
+        videos without a counterpart, are cached per videoId.
+        """
+        missing_video_ids = [
+            video_id for video_id in video_ids if video_id not in self.counterparts
+        ]
+        if missing_video_ids:
+            pages = -(-playlist_length // WATCH_PLAYLIST_PAGE)
+            watch_tracks = []
+            with PROFILER.span("fetch"):
+                if len(missing_video_ids) > pages:
+                    try:
+                        watch_tracks = self.ytmusic.get_watch_playlist(
+                            playlistId=playlist_id, limit=playlist_length
+                        )["tracks"]
+                    except Exception as e:
+                        print(
+                            f"Error resolving counterparts of {playlist_id}: {str(e)}"
+                        )
+                covered_video_ids = {
+                    video["videoId"]
+                    for track in watch_tracks
+                    for video in (track, track.get("counterpart") or track)
+                }
+                for video_id in missing_video_ids:
+                    if video_id in covered_video_ids:
+                        continue
+                    try:
+                        watch_tracks += self.ytmusic.get_watch_playlist(
+                            video_id, limit=1
+                        )["tracks"][:1]
+                    except Exception as e:
+                        print(f"Error resolving counterpart of {video_id}: {str(e)}")
+
+            # Counterparts link both ways, but only songs are wanted
+            songs = {}
+            for track in watch_tracks:
+                counterpart = track.get("counterpart")
+                if not counterpart:
+                    continue
+                for video, other in ((track, counterpart), (counterpart, track)):
+                    if other.get("videoType") == "MUSIC_VIDEO_TYPE_ATV":
+                        songs[video["videoId"]] = other
+            for video_id in missing_video_ids:
+                song = songs.get(video_id)
+                self.counterparts[video_id] = song and song | {
+                    "duration": song.get("length"),
+                    "duration_seconds": sum(
+                        int(part) * 60**i
+                        for i, part in enumerate(
+                            reversed((song.get("length") or "0").split(":"))
+                        )
+                    ),
+                }
+        return {video_id: self.counterparts[video_id] for video_id in video_ids}
+
+    def get_playlist_items(self, playlist_id):
+        return self.fetch_all(
             self.youtube.playlistItems().list,
             playlistId=playlist_id,
             part="contentDetails,id,snippet,status",
         )
-        videos_details = []
-        videos_ratings = []
-        all_video_ids = list(
-            {
-                videoId: None
-                for videoId in [
-                    track["contentDetails"]["videoId"] for track in tracks_from_youtube
-                ]
-                + [track["videoId"] or track["title"] for track in tracks_from_ytmusic]
-            }.keys()
-        )
-        for i in range(0, len(all_video_ids), MAX_RESULTS):
-            video_ids_str = ",".join(all_video_ids[i : i + MAX_RESULTS])
-            videos_chunk = (
-                self.youtube.videos()
-                .list(
-                    part="contentDetails,id,liveStreamingDetails,paidProductPlacementDetails,recordingDetails,snippet,statistics,status,topicDetails",
-                    id=video_ids_str,
-                    hl="en",
-                )
-                .execute()["items"]
+
+    def get_tracks(self, playlist_title, playlist_id=None, playlist_items=None):
+        if self.offline:
+            return self.library.get_tracks(playlist_title)
+
+        playlist_id = playlist_id or self.get_playlist_id(playlist_title)
+        with PROFILER.span("fetch"):
+            tracks_from_ytmusic = self.ytmusic.get_playlist(playlist_id, None)["tracks"]
+            tracks_from_youtube = (
+                playlist_items
+                if playlist_items is not None
+                else self.get_playlist_items(playlist_id)
+            )
+            videos_details = []
+            videos_ratings = []
+            all_video_ids = list(
+                {
+                    videoId: None
+                    for videoId in [
+                        track["contentDetails"]["videoId"]
+                        for track in tracks_from_youtube
+                    ]
+                    + [
+                        track["videoId"] or track["title"]
+                        for track in tracks_from_ytmusic
+                    ]
+                }.keys()
             )
-            videos_details.extend(videos_chunk)
-            videos_chunk = (
-                self.youtube.videos()
-                .getRating(
-                    id=video_ids_str,
+            for i in range(0, len(all_video_ids), MAX_RESULTS):
+                video_ids_str = ",".join(all_video_ids[i : i + MAX_RESULTS])
+                videos_chunk = (
+                    self.youtube.videos()
+                    .list(
+                        part="contentDetails,id,liveStreamingDetails,paidProductPlacementDetails,recordingDetails,snippet,statistics,status,topicDetails",
+                        id=video_ids_str,
+                        hl="en",
+                    )
+                    .execute()["items"]
                 )
-                .execute()["items"]
+                videos_details.extend(videos_chunk)
+
+            # Liked videos are answered from the liked set, and getRating
+            # is only called for the ids it cannot decide
+            liked_video_ids = self.get_liked_video_ids() if self.liked_songs else set()
+            videos_ratings.extend(
+                {"videoId": video_id, "rating": "like"}
+                for video_id in all_video_ids
+                if video_id in liked_video_ids
             )
-            videos_ratings.extend(videos_chunk)
+            undecided_video_ids = [
+                video_id
+                for video_id in all_video_ids
+                if video_id not in liked_video_ids
+            ]
+            for i in range(0, len(undecided_video_ids), MAX_RESULTS):
+                videos_chunk = (
+                    self.youtube.videos()
+                    .getRating(
+                        id=",".join(undecided_video_ids[i : i + MAX_RESULTS]),
+                    )
+                    .execute()["items"]
+                )
+                videos_ratings.extend(videos_chunk)
         youtube_dict = {
             track["contentDetails"]["videoId"]: track for track in tracks_from_youtube
         }
         video_details_dict = {track["id"]: track for track in videos_details}
         video_ratings_dict = {track["videoId"]: track for track in videos_ratings}
         ytmusic_dict = {track["videoId"]: track for track in tracks_from_ytmusic}
+        self.ytmusic_tracks.update(ytmusic_dict)
 
         # Save original playlist memberships before enrichment
         youtube_ids = set(youtube_dict.keys())
         ytmusic_ids = set(ytmusic_dict.keys())
 
-        # Enrich ytmusic data for tracks only in YouTube
-        for video_id in youtube_ids - ytmusic_ids:
-            ytmusic_dict[video_id] = self.ytmusic.get_song(video_id)
+        # Resolve song counterparts of tracks only in YouTube, and only
+        # enrich ytmusic data for the ones without a counterpart
+        counterparts = self.get_counterparts(
+            playlist_id, list(youtube_ids - ytmusic_ids), len(tracks_from_youtube)
+        )
+        with PROFILER.span("enrich"):
+            for video_id in youtube_ids - ytmusic_ids:
+                if counterparts[video_id]:
+                    continue
+                if video_id not in self.songs:
+                    self.songs[video_id] = self.ytmusic.get_song(video_id)
+                ytmusic_dict[video_id] = self.songs[video_id]
 
         # Build tracks with categorization (use lists to handle duplicates)
-        youtube_only = []
-        ytmusic_only = []
-        result = []
-
-        for videoId in all_video_ids:
-            track = {
-                "videoId": videoId,
-                "youtube": youtube_dict.get(videoId, {}),
-                "details": video_details_dict.get(videoId, {}),
-                "rating": video_ratings_dict.get(videoId, {}),
-                "ytmusic": ytmusic_dict.get(videoId, {}),
-            }
-            track.update(YTPlaylists.get_track_details(track))
-
-            in_youtube = videoId in youtube_ids
-            in_ytmusic = videoId in ytmusic_ids
-
-            if in_youtube and in_ytmusic:
-                result.append(track)
-            elif in_youtube:
-                youtube_only.append(track)
-            elif in_ytmusic:
-                ytmusic_only.append(track)
-
-        # Match and combine tracks by sanitized title
-        ytmusic_remaining = ytmusic_only.copy()
-
-        for yt_track in youtube_only:
-            yt_sanitized = YTPlaylists.sanitize_track_title(yt_track["title"])
-
-            # Find matching ytmusic track
-            matched_ytm = None
-            for ytm_track in ytmusic_remaining:
-                ytm_sanitized = YTPlaylists.sanitize_track_title(ytm_track["title"])
-                if yt_sanitized == ytm_sanitized:
-                    matched_ytm = ytm_track
-                    ytmusic_remaining.remove(ytm_track)
-                    break
-
-            if matched_ytm:
-                # Combine the tracks
-                combined = {
-                    "videoId": matched_ytm["videoId"],
-                    "youtube": yt_track["youtube"],
-                    "details": yt_track["details"],
-                    "rating": yt_track["rating"],
-                    "ytmusic": matched_ytm["ytmusic"],
+        with PROFILER.span("match"):
+            youtube_only = []
+            ytmusic_only = []
+            result = []
+
+            for videoId in all_video_ids:
+                track = {
+                    "videoId": videoId,
+                    "youtube": youtube_dict.get(videoId, {}),
+                    "details": video_details_dict.get(videoId, {}),
+                    "rating": video_ratings_dict.get(videoId, {}),
+                    "ytmusic": ytmusic_dict.get(videoId, {}),
                 }
-                combined.update(YTPlaylists.get_track_details(combined))
-                combined["historicalLink"] = (
-                    f"[{yt_track['videoId']}](https://quiteaplaylist.com/search?url=https://www.youtube.com/watch?v={yt_track['videoId']})"
-                )
-                result.append(combined)
-            else:
-                # No match, keep original but remove clickable link
-                yt_track["titleLink"] = yt_track["title"]
-                result.append(yt_track)
-
-        # Add remaining unmatched ytmusic tracks
-        result.extend(ytmusic_remaining)
-
-        # Sort by title
-        result.sort(key=lambda t: t["title"].lower())
+                track.update(YTPlaylists.get_track_details(track))
+
+                in_youtube = videoId in youtube_ids
+                in_ytmusic = videoId in ytmusic_ids
+
+                if in_youtube and in_ytmusic:
+                    result.append(track)
+                elif in_youtube:
+                    youtube_only.append(track)
+                elif in_ytmusic:
+                    ytmusic_only.append(track)
+
+            # Match and combine tracks by song counterpart,
+            # then by sanitized title
+            ytmusic_remaining = ytmusic_only.copy()
+            claimed_video_ids = set()
+
+            for yt_track in youtube_only:
+                yt_sanitized = YTPlaylists.sanitize_track_title(yt_track["title"])
+                counterpart = counterparts[yt_track["videoId"]]
+
+                # Find matching ytmusic track
+                matched_ytm = None
+                for ytm_track in ytmusic_remaining:
+                    ytm_sanitized = YTPlaylists.sanitize_track_title(ytm_track["title"])
+                    if (
+                        ytm_track["videoId"] == counterpart["videoId"]
+                        if counterpart
+                        else yt_sanitized == ytm_sanitized
+                    ):
+                        matched_ytm = ytm_track
+                        ytmusic_remaining.remove(ytm_track)
+                        break
+
+                if matched_ytm:
+                    # Combine the tracks
+                    combined = {
+                        "videoId": matched_ytm["videoId"],
+                        "youtube": yt_track["youtube"],
+                        "details": yt_track["details"],
+                        "rating": yt_track["rating"],
+                        "ytmusic": matched_ytm["ytmusic"],
+                    }
+                    combined.update(YTPlaylists.get_track_details(combined))
+                    combined["historicalLink"] = (
+                        f"[{yt_track['videoId']}](https://quiteaplaylist.com/search?url=https://www.youtube.com/watch?v={yt_track['videoId']})"
+                    )
+                    result.append(combined)
+                else:
+                    # No match, keep original but remove clickable link
+                    yt_track["titleLink"] = yt_track["title"]
+                    # Offer the counterpart song for replace_with_ytmusic when
+                    # it is not in the playlist yet nor offered for another video
+                    if (
+                        counterpart
+                        and counterpart["videoId"] not in youtube_ids
+                        and counterpart["videoId"] not in ytmusic_ids
+                        and counterpart["videoId"] not in claimed_video_ids
+                    ):
+                        claimed_video_ids.add(counterpart["videoId"])
+                        yt_track["counterpart"] = counterpart
+                    result.append(yt_track)
+
+            # Add remaining unmatched ytmusic tracks
+            result.extend(ytmusic_remaining)
+
+            # Sort by title
+            result.sort(key=lambda t: t["title"].lower())
+
+        if self.library:
+            self.library.record(playlist_title, playlist_id, result)
 
         return result
 
@@ -373,7 +1072,95 @@ class YTPlaylists:
 
         return list(reversed(lis))
 
-    def sort_playlist(self, target_playlist_title, key):
+    def get_ytmusic_tracks(self, playlist_id, video_ids):
+        """
+        YTMusic track data for video_ids. The playlist is only fetched
+        from YTMusic when some of them are not cached yet.
+        """
+        if any(video_id not in self.ytmusic_tracks for video_id in video_ids):
+            with PROFILER.span("fetch"):
+                tracks = self.ytmusic.get_playlist(playlist_id, None)["tracks"]
+            self.ytmusic_tracks.update({track["videoId"]: track for track in tracks})
+            for video_id in video_ids:
+                self.ytmusic_tracks.setdefault(video_id, {})
+        return {video_id: self.ytmusic_tracks[video_id] for video_id in video_ids}
+
+    def get_uninsertable_video_ids(self, video_ids):
+        """
+        Videos that could not be added back after clearing a playlist:
+        private, deleted, still processing or region restricted.
+        """
+        insertable_video_ids = set()
+        with PROFILER.span("fetch"):
+            for i in range(0, len(video_ids), MAX_RESULTS):
+                for video in (
+                    self.youtube.videos()
+                    .list(
+                        part="contentDetails,status",
+                        id=",".join(video_ids[i : i + MAX_RESULTS]),
+                    )
+                    .execute()["items"]
+                ):
+                    if (
+                        video["status"]["privacyStatus"] != "private"
+                        and video["status"]["uploadStatus"] == "processed"
+                        and "regionRestriction" not in video["contentDetails"]
+                    ):
+                        insertable_video_ids.add(video["id"])
+        return [
+            video_id for video_id in video_ids if video_id not in insertable_video_ids
+        ]
+
+    def plan_sort(self, playlist_length, lis_length, quota_budget, rebuild=True):
+        """
+        Estimate quota units, calls and wall time of sorting by moving the
+        tracks outside the LIS or by clearing and re-adding the playlist.
+        Rebuilding includes checking that every video can be added back.
+        Returns all estimates and the fastest strategy within quota_budget.
+        """
+        moves = playlist_length - lis_length
+        pages = -(-playlist_length // MAX_RESULTS)
+        strategies = [
+            {
+                "strategy": "move",
+                "quota": moves * YOUTUBE_WRITE_UNITS,
+                "calls": moves,
+                "seconds": moves * YOUTUBE_CALL_SECONDS,
+            }
+        ]
+        if rebuild and self.bulk_mutations:
+            chunks = -(-playlist_length // BULK_CHUNK)
+            strategies.append(
+                {
+                    "strategy": "rebuild",
+                    "quota": 2 * pages,
+                    "calls": 1 + 2 * chunks + 2 * pages,
+                    "seconds": (1 + 2 * chunks) * YTMUSIC_CALL_SECONDS
+                    + 2 * pages * YOUTUBE_CALL_SECONDS,
+                }
+            )
+        elif rebuild:
+            strategies.append(
+                {
+                    "strategy": "rebuild",
+                    "quota": 2 * pages + 2 * playlist_length * YOUTUBE_WRITE_UNITS,
+                    "calls": 2 * pages + 2 * playlist_length,
+                    "seconds": (2 * pages + 2 * playlist_length) * YOUTUBE_CALL_SECONDS,
+                }
+            )
+        affordable = [
+            strategy for strategy in strategies if strategy["quota"] <= quota_budget
+        ]
+        chosen = (
+            min(affordable, key=lambda strategy: strategy["seconds"])
+            if affordable
+            else None
+        )
+        return strategies, chosen
+
+    def sort_playlist(
+        self, target_playlist_title, key="title", quota_budget=QUOTA_BUDGET
+    ):
         playlist_id = self.get_playlist_id(target_playlist_title)
 
         # Get current playlist items directly from YouTube API
@@ -383,33 +1170,143 @@ class YTPlaylists:
             part="contentDetails,id,snippet",
         )
 
-        # Sort items by video title
-        sorted_items = sorted(current_items, key=lambda item: key(item))
+        # Only keys other than title need YTMusic data
+        ytmusic_tracks = (
+            self.get_ytmusic_tracks(
+                playlist_id,
+                [item["contentDetails"]["videoId"] for item in current_items],
+            )
+            if key != "title"
+            else defaultdict(dict)
+        )
+
+        # Sort items by key
+        with PROFILER.span("plan"):
+            sorted_items = sorted(
+                current_items,
+                key=lambda item: SORT_KEYS[key](
+                    item, ytmusic_tracks[item["contentDetails"]["videoId"]]
+                ),
+            )
 
-        # Create mapping from playlist item ID to current position
-        current_map = {
-            item["id"]: {
-                "position": item["snippet"]["position"],
-                "videoId": item["contentDetails"]["videoId"],
-                "title": item["snippet"]["title"],
+            # Create mapping from playlist item ID to current position
+            current_map = {
+                item["id"]: {
+                    "position": item["snippet"]["position"],
+                    "videoId": item["contentDetails"]["videoId"],
+                    "title": item["snippet"]["title"],
+                }
+                for item in current_items
             }
-            for item in current_items
-        }
 
-        # Create array of current positions in sorted order
-        current_positions = []
-        for item in sorted_items:
-            playlist_item_id = item["id"]
-            current_positions.append(current_map[playlist_item_id]["position"])
+            # Create array of current positions in sorted order
+            current_positions = []
+            for item in sorted_items:
+                playlist_item_id = item["id"]
+                current_positions.append(current_map[playlist_item_id]["position"])
 
-        # Find LIS - tracks already in correct relative order
-        lis_indices = self.longest_increasing_subsequence(current_positions)
-        lis_set = set(lis_indices)
+            # Find LIS - tracks already in correct relative order
+            lis_indices = self.longest_increasing_subsequence(current_positions)
+            lis_set = set(lis_indices)
 
         print(f"Total tracks: {len(sorted_items)}")
         print(f"Tracks already in correct order (LIS): {len(lis_indices)}")
         print(f"Tracks to move: {len(sorted_items) - len(lis_indices)}")
 
+        with PROFILER.span("plan"):
+            strategies, chosen = self.plan_sort(
+                len(sorted_items), len(lis_indices), quota_budget
+            )
+        sorted_video_ids = [item["contentDetails"]["videoId"] for item in sorted_items]
+        if chosen and chosen["strategy"] == "rebuild":
+            # Clearing is only safe when every video can be added back
+            uninsertable_video_ids = self.get_uninsertable_video_ids(sorted_video_ids)
+            if uninsertable_video_ids:
+                print(
+                    f"Not rebuilding: {len(uninsertable_video_ids)} videos could not "
+                    f"be added back: {uninsertable_video_ids}"
+                )
+                with PROFILER.span("plan"):
+                    strategies, chosen = self.plan_sort(
+                        len(sorted_items),
+                        len(lis_indices),
+                        quota_budget,
+                        rebuild=False,
+                    )
+        print(
+            "\n"
+            + self.create_md_table(
+                "Sort plan",
+                ("strategy", "quota", "calls", "seconds"),
+                [
+                    {
+                        "strategy": strategy["strategy"],
+                        "quota": str(strategy["quota"]),
+                        "calls": str(strategy["calls"]),
+                        "seconds": f"{strategy['seconds']:.0f}",
+                    }
+                    for strategy in strategies
+                ],
+            )
+            + "\n"
+        )
+        if not chosen:
+            print(f"No strategy fits the quota budget of {quota_budget}")
+            return
+        print(f"Chosen strategy: {chosen['strategy']}")
+        self.invalidate(target_playlist_title)
+
+        if chosen["strategy"] == "rebuild":
+            move = strategies[0]
+            if move["quota"] > quota_budget:
+                reason = f"moving needs {move['quota']} quota units"
+            else:
+                reason = f"moving takes about {move['seconds']:.0f} seconds"
+            print(
+                f"Rebuilding the playlist because {reason} and every video "
+                "can be added back"
+            )
+            with PROFILER.span("mutate"):
+                try:
+                    self.clear_playlist(target_playlist_title)
+                except Exception as e:
+                    print(f"Error clearing {target_playlist_title}: {str(e)}")
+
+                # Only add back what is missing, whatever the clear removed
+                try:
+                    remaining = Counter(
+                        item["contentDetails"]["videoId"]
+                        for item in self.fetch_all(
+                            self.youtube.playlistItems().list,
+                            playlistId=playlist_id,
+                            part="contentDetails",
+                        )
+                    )
+                except Exception as e:
+                    # Duplicates are easier to fix than lost videos
+                    print(f"Error reading {target_playlist_title}: {str(e)}")
+                    remaining = Counter()
+                missing_video_ids = []
+                for video_id in sorted_video_ids:
+                    if remaining[video_id]:
+                        remaining[video_id] -= 1
+                    else:
+                        missing_video_ids.append(video_id)
+                failed_video_ids = self.add_playlist_items(
+                    playlist_id, missing_video_ids
+                )
+            if len(missing_video_ids) < len(sorted_video_ids):
+                print(
+                    f"{len(sorted_video_ids) - len(missing_video_ids)} videos were "
+                    "not removed, so the playlist is only partly sorted"
+                )
+            if failed_video_ids:
+                print(
+                    f"Could not add back {len(failed_video_ids)} videos: "
+                    f"{failed_video_ids}"
+                )
+            return
+
         # Track current positions (will be updated as we move items)
         current_positions_map = {
             item["id"]: current_map[item["id"]]["position"] for item in current_items
@@ -421,72 +1318,74 @@ class YTPlaylists:
 
         # Update positions for tracks that need to be moved (not in LIS)
         # Process in FORWARD order so earlier positions are already correct
-        for idx in range(len(sorted_items)):
-            if idx not in lis_set:
-                item = sorted_items[idx]
-                playlist_item_id = item["id"]
-                video_id = current_map[playlist_item_id]["videoId"]
-                current_pos = current_positions_map[playlist_item_id]
-                target_pos = idx
-                title = item["snippet"]["title"]
-
-                # Skip if already in correct position
-                if current_pos == target_pos:
-                    print(f"Skipping {title} - already at position {target_pos}")
-                    continue
-
-                tracks_to_move.append(
-                    {
-                        "titleLink": f"[{title}](https://www.youtube.com/watch?v={video_id})",
-                        "sourcePosition": str(current_pos),
-                        "targetPosition": str(target_pos),
-                    }
-                )
+        with PROFILER.span("mutate"):
+            for idx in range(len(sorted_items)):
+                if idx not in lis_set:
+                    item = sorted_items[idx]
+                    playlist_item_id = item["id"]
+                    video_id = current_map[playlist_item_id]["videoId"]
+                    current_pos = current_positions_map[playlist_item_id]
+                    target_pos = idx
+                    title = item["snippet"]["title"]
+
+                    # Skip if already in correct position
+                    if current_pos == target_pos:
+                        print(f"Skipping {title} - already at position {target_pos}")
+                        continue
+
+                    tracks_to_move.append(
+                        {
+                            "titleLink": f"[{title}](https://www.youtube.com/watch?v={video_id})",
+                            "sourcePosition": str(current_pos),
+                            "targetPosition": str(target_pos),
+                        }
+                    )
 
-                self.youtube.playlistItems().update(
-                    part="snippet",
-                    body={
-                        "id": playlist_item_id,
-                        "snippet": {
-                            "playlistId": playlist_id,
-                            "position": target_pos,
-                            "resourceId": {
-                                "kind": "youtube#video",
-                                "videoId": video_id,
+                    self.youtube.playlistItems().update(
+                        part="snippet",
+                        body={
+                            "id": playlist_item_id,
+                            "snippet": {
+                                "playlistId": playlist_id,
+                                "position": target_pos,
+                                "resourceId": {
+                                    "kind": "youtube#video",
+                                    "videoId": video_id,
+                                },
                             },
                         },
-                    },
-                ).execute()
-                actual_updates += 1
-
-                # Update position tracking: simulate YouTube's position shifts
-                # When moving from current_pos to target_pos, items in between shift
-                if current_pos > target_pos:
-                    # Moving up: items from target_pos to current_pos-1 shift down
-                    for item_id, pos in current_positions_map.items():
-                        if target_pos <= pos < current_pos:
-                            current_positions_map[item_id] = pos + 1
-                elif current_pos < target_pos:
-                    # Moving down: items from current_pos+1 to target_pos shift up
-                    for item_id, pos in current_positions_map.items():
-                        if current_pos < pos <= target_pos:
-                            current_positions_map[item_id] = pos - 1
-
-                # Update the moved item's position
-                current_positions_map[playlist_item_id] = target_pos
+                    ).execute()
+                    actual_updates += 1
+
+                    # Update position tracking: simulate YouTube's position shifts
+                    # When moving from current_pos to target_pos, items in between shift
+                    if current_pos > target_pos:
+                        # Moving up: items from target_pos to current_pos-1 shift down
+                        for item_id, pos in current_positions_map.items():
+                            if target_pos <= pos < current_pos:
+                                current_positions_map[item_id] = pos + 1
+                    elif current_pos < target_pos:
+                        # Moving down: items from current_pos+1 to target_pos shift up
+                        for item_id, pos in current_positions_map.items():
+                            if current_pos < pos <= target_pos:
+                                current_positions_map[item_id] = pos - 1
+
+                    # Update the moved item's position
+                    current_positions_map[playlist_item_id] = target_pos
 
         print(f"Actual API update calls made: {actual_updates}")
 
         # Print table of moved tracks
-        if tracks_to_move:
-            print(
-                "\n"
-                + self.create_md_table(
-                    "Tracks Moved",
-                    ["titleLink", "sourcePosition", "targetPosition"],
-                    tracks_to_move,
+        with PROFILER.span("report"):
+            if tracks_to_move:
+                print(
+                    "\n"
+                    + self.create_md_table(
+                        "Tracks Moved",
+                        ["titleLink", "sourcePosition", "targetPosition"],
+                        tracks_to_move,
+                    )
                 )
-            )
 
     @staticmethod
     def get_unavailable_tracks(tracks):
@@ -549,6 +1448,121 @@ class YTPlaylists:
     def sanitize_track_title(track_title):
         return track_title.lower().split("(")[0].split("[")[0].strip()
 
+    @staticmethod
+    def load_clean_map():
+        """
+        Explicit videoId -> {"track": clean track or None, "checked": timestamp}
+        """
+        try:
+            with open(CLEAN_MAP_FILE, "r") as clean_map_file:
+                return load(clean_map_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def save_clean_map(clean_map):
+        write_json(CLEAN_MAP_FILE, clean_map)
+
+    def search_clean_track(self, explicit_track):
+        # if track["title"] == "Empire State Of Mind (feat. Alicia Keys)":
+        #     print ("ESM")
+        artist = (
+            explicit_track["artists"][0]["name"] if explicit_track["artists"] else ""
+        )
+        result_tracks = self.ytmusic.search(
+            f"{explicit_track['title']}{' ' if artist else ''}{artist}",
+            "songs",
+            None,
+            10,
+        )
+        result_tracks = [
+            result_track
+            for result_track in result_tracks
+            if self.is_clean_counterpart(explicit_track, result_track)
+        ]
+        return result_tracks[0] if result_tracks else None
+
+    @staticmethod
+    def is_clean_counterpart(explicit_track, result_track):
+        return (
+            not result_track["isExplicit"]
+            and YTPlaylists.sanitize_track_title(result_track["title"])
+            == YTPlaylists.sanitize_track_title(explicit_track["title"])
+            # and result.get("album", {})["id"] == track.get("album", {})["id"]
+            and (
+                (
+                    result_track["artists"][0].get("id")
+                    if result_track["artists"]
+                    else ""
+                )
+                == (
+                    explicit_track["artists"][0].get("id")
+                    if explicit_track["artists"]
+                    else ""
+                )
+            )
+            and explicit_track["duration_seconds"]
+            >= result_track["duration_seconds"] - 5
+        )
+
+    def get_album_catalog(self, album_id):
+        """
+        Clean tracks of an album and of its clean other versions, by
+        sanitized title. Each album is only fetched once per instance.
+        """
+        if album_id not in self.album_catalogs:
+            catalog = defaultdict(list)
+            albums = []
+            with PROFILER.span("fetch"):
+                try:
+                    albums.append((album_id, self.ytmusic.get_album(album_id)))
+                except Exception as e:
+                    print(f"Error fetching album {album_id}: {str(e)}")
+                # One version failing does not drop the others
+                other_versions = (
+                    albums[0][1].get("other_versions", []) if albums else []
+                )
+                for version in other_versions:
+                    if version.get("isExplicit"):
+                        continue
+                    try:
+                        albums.append(
+                            (
+                                version["browseId"],
+                                self.ytmusic.get_album(version["browseId"]),
+                            )
+                        )
+                    except Exception as e:
+                        print(f"Error fetching album {version['browseId']}: {str(e)}")
+
+            for browse_id, album in albums:
+                for track in album["tracks"]:
+                    if not track.get("videoId") or track.get("isExplicit"):
+                        continue
+                    catalog[self.sanitize_track_title(track["title"])].append(
+                        track
+                        | {
+                            "artists": track.get("artists") or album["artists"],
+                            "album": {"name": album["title"], "id": browse_id},
+                        }
+                    )
+            self.album_catalogs[album_id] = catalog
+        return self.album_catalogs[album_id]
+
+    def find_clean_track(self, explicit_track):
+        """
+        Match against the catalog of the explicit track's album first, which
+        is shared by every track of that album, and search otherwise.
+        """
+        album_id = (explicit_track["ytmusic"].get("album") or {}).get("id")
+        if album_id:
+            for catalog_track in self.get_album_catalog(album_id)[
+                self.sanitize_track_title(explicit_track["title"])
+            ]:
+                if self.is_clean_counterpart(explicit_track, catalog_track):
+                    return catalog_track
+        return self.search_clean_track(explicit_track)
+
     def explicit_to_clean(
         self,
         explicit_playlist_title,
@@ -569,48 +1583,42 @@ class YTPlaylists:
         clean_playlist_tracks = clean_tracks
         uncleanable_tracks = []
 
-        for explicit_track in explicit_tracks:
-            # if track["title"] == "Empire State Of Mind (feat. Alicia Keys)":
-            #     print ("ESM")
-            artist = (
-                explicit_track["artists"][0]["name"]
-                if explicit_track["artists"]
-                else ""
-            )
-            result_tracks = self.ytmusic.search(
-                f"{explicit_track['title']}{' ' if artist else ''}{artist}",
-                "songs",
-                None,
-                10,
-            )
-            result_tracks = [
-                result_track
-                for result_track in result_tracks
-                if not result_track["isExplicit"]
-                and self.sanitize_track_title(result_track["title"])
-                == self.sanitize_track_title(explicit_track["title"])
-                # and result.get("album", {})["id"] == track.get("album", {})["id"]
-                and (
-                    (
-                        result_track["artists"][0]["id"]
-                        if result_track["artists"]
-                        else ""
-                    )
-                    == (
-                        explicit_track["artists"][0]["id"]
-                        if explicit_track["artists"]
-                        else ""
-                    )
-                )
-                and explicit_track["duration_seconds"]
-                >= result_track["duration_seconds"] - 5
-            ]
-            if result_tracks:
-                clean_playlist_tracks += [result_tracks[0]]
-            else:
-                uncleanable_tracks += [explicit_track]
+        # Only search for tracks without a known result, or whose
+        # uncleanable result is older than UNCLEANABLE_RETRY_DAYS
+        clean_map = self.load_clean_map()
+        with PROFILER.span("match"):
+            for explicit_track in explicit_tracks:
+                mapping = clean_map.get(explicit_track["videoId"])
+                if not mapping or (
+                    not mapping["track"]
+                    and time() - mapping["checked"] > UNCLEANABLE_RETRY_DAYS * 86400
+                ):
+                    clean_track = self.find_clean_track(explicit_track)
+                    mapping = {
+                        "track": clean_track
+                        and {
+                            field: clean_track.get(field)
+                            for field in (
+                                "videoId",
+                                "title",
+                                "artists",
+                                "album",
+                                "duration",
+                                "duration_seconds",
+                            )
+                        },
+                        "checked": time(),
+                    }
+                    clean_map[explicit_track["videoId"]] = mapping
+
+                if mapping["track"]:
+                    clean_playlist_tracks += [mapping["track"]]
+                else:
+                    uncleanable_tracks += [explicit_track]
+        self.save_clean_map(clean_map)
 
-        clean_playlist_tracks = sorted(clean_playlist_tracks, key=key)
+        with PROFILER.span("plan"):
+            clean_playlist_tracks = sorted(clean_playlist_tracks, key=key)
 
         self.overwrite_playlist(
             clean_playlist_title, archive_playlist_title, clean_playlist_tracks
@@ -630,44 +1638,32 @@ class YTPlaylists:
         ]
         return uncleanable_tracks, added_tracks, removed_tracks
 
-    def replace_with_ytmusic(self, playlist_title):
+    @staticmethod
+    def plan_replacements(playlist_items, tracks):
         """
-        Replace YouTube songs with their YouTube Music equivalents.
-        For matched songs, removes YouTube version and inserts
-        YouTube Music version at the same position.
-
-        Returns: replaced_tracks list
+        Build the replacement plan for replace_with_ytmusic.
+        Returns the replacements in ascending position order and the
+        expected videoId order of the playlist once they are applied.
         """
-        playlist_id = self.get_playlist_id(playlist_title)
-        if not playlist_id:
-            return []
-
-        # Get current playlist items with positions
-        playlist_items = self.fetch_all(
-            self.youtube.playlistItems().list,
-            playlistId=playlist_id,
-            part="contentDetails,id,snippet",
-        )
-
         # Create a mapping of videoId to playlist item ID and position
         youtube_item_map = {
             item["contentDetails"]["videoId"]: {"id": item["id"], "position": idx}
             for idx, item in enumerate(playlist_items)
         }
 
-        # Get all tracks with matching information
-        tracks = self.get_tracks(playlist_title)
-
         # Find tracks to replace
-        tracks_to_replace = []
+        replacements = []
         for track in tracks:
             # Get the YouTube video ID that's currently in the playlist
             youtube_video_id = (
                 track.get("youtube", {}).get("contentDetails", {}).get("videoId")
             )
 
-            # Get the YouTube Music video ID
-            ytmusic_video_id = track.get("ytmusic", {}).get("videoId")
+            # Get the YouTube Music video ID, or the song counterpart
+            # of a video that YTMusic does not list
+            ytmusic_video_id = track.get("ytmusic", {}).get("videoId") or (
+                track.get("counterpart") or {}
+            ).get("videoId")
 
             # Check if track is in YouTube playlist with different
             # YTMusic version
@@ -678,7 +1674,7 @@ class YTPlaylists:
                 and youtube_video_id in youtube_item_map
             ):
 
-                tracks_to_replace.append(
+                replacements.append(
                     {
                         "track": track,
                         "youtube_video_id": youtube_video_id,
@@ -688,38 +1684,103 @@ class YTPlaylists:
                     }
                 )
 
-        # Sort by position in reverse order to avoid position shifts
-        tracks_to_replace.sort(key=lambda x: x["position"], reverse=True)
+        replacements.sort(key=lambda x: x["position"])
 
-        # Perform the replacements
-        replaced_tracks = []
-        for item in tracks_to_replace:
-            try:
-                # Delete the YouTube version
-                self.youtube.playlistItems().delete(
-                    id=item["playlist_item_id"]
-                ).execute()
+        final_order = [item["contentDetails"]["videoId"] for item in playlist_items]
+        for item in replacements:
+            final_order[item["position"]] = item["ytmusic_video_id"]
 
-                # Insert the YouTube Music version at the same position
-                self.youtube.playlistItems().insert(
-                    part="snippet",
-                    body={
-                        "snippet": {
-                            "playlistId": playlist_id,
-                            "position": item["position"],
-                            "resourceId": {
-                                "kind": "youtube#video",
-                                "videoId": item["ytmusic_video_id"],
-                            },
-                        }
-                    },
-                ).execute()
+        return replacements, final_order
 
-                replaced_tracks.append(item["track"])
+    def replace_with_ytmusic(self, playlist_title):
+        """
+        Replace YouTube songs with their YouTube Music equivalents.
+        For matched songs, removes YouTube version and inserts
+        YouTube Music version at the same position.
 
-            except Exception as e:
+        Returns: replaced_tracks list
+        """
+        playlist_id = self.get_playlist_id(playlist_title)
+        if not playlist_id:
+            return []
+
+        # Fetch the playlist once and share it with get_tracks
+        playlist_items = self.get_playlist_items(playlist_id)
+        tracks = self.get_tracks(playlist_title, playlist_id, playlist_items)
+        with PROFILER.span("plan"):
+            replacements, final_order = self.plan_replacements(playlist_items, tracks)
+        if not replacements:
+            return []
+        self.invalidate(playlist_title)
+
+        # Delete all YouTube versions in batched requests
+        with PROFILER.span("mutate"):
+            delete_errors = self.execute_batch(
+                [
+                    (
+                        item["playlist_item_id"],
+                        self.youtube.playlistItems().delete(
+                            id=item["playlist_item_id"]
+                        ),
+                    )
+                    for item in replacements
+                ]
+            )
+
+            # Insert in ascending position order so every earlier position is
+            # already final when an item is inserted
+            replaced_tracks = []
+            missing = 0
+            for item in replacements:
                 title = item["track"]["title"]
-                print(f"Error replacing {title}: {str(e)}")
+                if item["playlist_item_id"] in delete_errors:
+                    # The YouTube version is still in its slot
+                    final_order[item["position"]] = item["youtube_video_id"]
+                    print(
+                        f"Error replacing {title}: {delete_errors[item['playlist_item_id']]}"
+                    )
+                    continue
+
+                try:
+                    # Insert the YouTube Music version at the same position
+                    self.youtube.playlistItems().insert(
+                        part="snippet",
+                        body={
+                            "snippet": {
+                                "playlistId": playlist_id,
+                                "position": item["position"] - missing,
+                                "resourceId": {
+                                    "kind": "youtube#video",
+                                    "videoId": item["ytmusic_video_id"],
+                                },
+                            }
+                        },
+                    ).execute()
+
+                    replaced_tracks.append(item["track"])
+
+                except Exception as e:
+                    # The slot is now empty, so later positions shift up by one
+                    final_order[item["position"]] = None
+                    missing += 1
+                    print(f"Error replacing {title}: {str(e)}")
+
+        # Verify the final order against the plan in one read
+        expected_order = [video_id for video_id in final_order if video_id]
+        actual_order = [
+            item["contentDetails"]["videoId"]
+            for item in self.fetch_all(
+                self.youtube.playlistItems().list,
+                playlistId=playlist_id,
+                part="contentDetails",
+            )
+        ]
+        if actual_order != expected_order:
+            mismatches = sum(
+                expected != actual
+                for expected, actual in zip(expected_order, actual_order)
+            ) + abs(len(expected_order) - len(actual_order))
+            print(f"Warning: {mismatches} positions differ from the replacement plan")
 
         return replaced_tracks
 
@@ -749,153 +1810,313 @@ def youtube_oauth(_: Namespace):
         token.write(credentials.to_json())
 
 
+def get_yt_playlists(args: Namespace):
+    library_index = (
+        LibraryIndex(args.library or LIBRARY_FILE)
+        if args.library or args.offline
+        else None
+    )
+    return YTPlaylists(library_index, args.offline, args.liked_songs)
+
+
+def print_freshness(yt_playlists: YTPlaylists, *playlist_titles):
+    if yt_playlists.offline:
+        for playlist_title in playlist_titles:
+            print(f"_{yt_playlists.library.freshness(playlist_title)}_\n")
+
+
 def compare(args: Namespace):
-    yt_playlists = YTPlaylists()
+    yt_playlists = get_yt_playlists(args)
+    print_freshness(yt_playlists, args.playlist_title_1, args.playlist_title_2)
     tracks_1 = yt_playlists.get_tracks(args.playlist_title_1)
     print(f"Size of {args.playlist_title_1}: {len(tracks_1)}")
     track_ids_1 = {track["videoId"] for track in tracks_1}
     tracks_2 = yt_playlists.get_tracks(args.playlist_title_2)
     print(f"Size of {args.playlist_title_2}: {len(tracks_2)}")
     track_ids_2 = {track["videoId"] for track in tracks_2}
-    print(
-        yt_playlists.create_md_table(
-            f"Tracks in {args.playlist_title_1} but not in {args.playlist_title_2}",
-            ("titleLink", "artistNames"),
-            [track for track in tracks_1 if track["videoId"] not in track_ids_2],
+    with PROFILER.span("report"):
+        print(
+            yt_playlists.create_md_table(
+                f"Tracks in {args.playlist_title_1} but not in {args.playlist_title_2}",
+                ("titleLink", "artistNames"),
+                [track for track in tracks_1 if track["videoId"] not in track_ids_2],
+            )
+            + "\n"
         )
-        + "\n"
-    )
-    print(
-        yt_playlists.create_md_table(
-            f"Tracks in {args.playlist_title_2} but not in {args.playlist_title_1}",
-            ("titleLink", "artistNames"),
-            [track for track in tracks_2 if track["videoId"] not in track_ids_1],
+        print(
+            yt_playlists.create_md_table(
+                f"Tracks in {args.playlist_title_2} but not in {args.playlist_title_1}",
+                ("titleLink", "artistNames"),
+                [track for track in tracks_2 if track["videoId"] not in track_ids_1],
+            )
+            + "\n"
         )
-        + "\n"
-    )
 
 
-def problems(args: Namespace):
-    yt_playlists = YTPlaylists()
-    tracks = yt_playlists.get_tracks(args.playlist_title)
-    print(
-        yt_playlists.create_md_table(
+def problem_tables(tracks, max_minutes):
+    return [
+        (
             "Unavailable songs",
             ("titleLink", "artistNames", "album", "privacyStatus", "historicalLink"),
-            yt_playlists.get_unavailable_tracks(tracks),
-        )
-        + "\n"
-    )
-    print(
-        yt_playlists.create_md_table(
+            YTPlaylists.get_unavailable_tracks(tracks),
+        ),
+        (
             "Duplicates",
             ("sanitizedTitle", "titleLink", "artistNames", "album"),
-            yt_playlists.get_duplicates(tracks),
-        )
-        + "\n"
-    )
-    print(
-        yt_playlists.create_md_table(
-            f"Songs longer than {args.max_minutes} minutes",
+            YTPlaylists.get_duplicates(tracks),
+        ),
+        (
+            f"Songs longer than {max_minutes} minutes",
             ("titleLink", "artistNames", "duration"),
-            yt_playlists.get_tracks_longer_than(tracks, args.max_minutes),
-        )
-        + "\n"
-    )
-    print(
-        yt_playlists.create_md_table(
+            YTPlaylists.get_tracks_longer_than(tracks, max_minutes),
+        ),
+        (
             "Unliked songs",
             ("titleLink", "artistNames", "likeStatus"),
-            yt_playlists.get_unliked_tracks(tracks),
-        )
-        + "\n"
-    )
-    print(
-        yt_playlists.create_md_table(
+            YTPlaylists.get_unliked_tracks(tracks),
+        ),
+        (
             "Low-quality",
             ("titleLink", "artistNames", "videoType"),
-            yt_playlists.get_low_quality_tracks(tracks),
-        )
-        + "\n"
-    )
-    # print(
-    #     yt_playlists.create_md_table(
-    #         "Title matches album",
-    #         ("titleLink", "artistNames", "album", "duration"),
-    #         yt_playlists.get_title_matches_album(tracks),
-    #     )
-    #     + "\n"
-    # )
-
-
-def sort(args: Namespace):
-    yt_playlists = YTPlaylists()
-    yt_playlists.sort_playlist(
-        args.target_playlist_title,
-        lambda item: item["snippet"]["title"].upper(),
-    )
+            YTPlaylists.get_low_quality_tracks(tracks),
+        ),
+        # (
+        #     "Title matches album",
+        #     ("titleLink", "artistNames", "album", "duration"),
+        #     YTPlaylists.get_title_matches_album(tracks),
+        # ),
+    ]
+
+
+def problems(args: Namespace, yt_playlists: YTPlaylists | None = None):
+    yt_playlists = yt_playlists or get_yt_playlists(args)
+    print_freshness(yt_playlists, args.playlist_title)
+    tracks = yt_playlists.get_tracks(args.playlist_title)
+    with PROFILER.span("report"):
+        for table_name, headers, records in problem_tables(tracks, args.max_minutes):
+            print(yt_playlists.create_md_table(table_name, headers, records) + "\n")
+
+
+def sort(args: Namespace, yt_playlists: YTPlaylists | None = None):
+    yt_playlists = yt_playlists or get_yt_playlists(args)
+    yt_playlists.sort_playlist(args.target_playlist_title, args.key, args.quota_budget)
 
 
-def clean(args: Namespace):
-    yt_playlists = YTPlaylists()
+def clean(args: Namespace, yt_playlists: YTPlaylists | None = None):
+    yt_playlists = yt_playlists or get_yt_playlists(args)
     uncleanable_tracks, added_tracks, removed_tracks = yt_playlists.explicit_to_clean(
         args.explicit_playlist_title,
         args.clean_playlist_title,
         args.archive_playlist_title,
         lambda track: track["title"].upper(),
     )
-    print(
-        yt_playlists.create_md_table(
-            "Added",
-            ("title", "artists"),
-            added_tracks,
+    with PROFILER.span("report"):
+        print(
+            yt_playlists.create_md_table(
+                "Added",
+                ("title", "artists"),
+                added_tracks,
+            )
+            + "\n"
         )
-        + "\n"
-    )
-    print(
-        yt_playlists.create_md_table(
-            "Removed",
-            ("title", "artists"),
-            removed_tracks,
+        print(
+            yt_playlists.create_md_table(
+                "Removed",
+                ("title", "artists"),
+                removed_tracks,
+            )
+            + "\n"
         )
-        + "\n"
-    )
-    print(
-        yt_playlists.create_md_table(
-            "Uncleanable",
-            ("title", "artists"),
-            uncleanable_tracks,
+        print(
+            yt_playlists.create_md_table(
+                "Uncleanable",
+                ("title", "artists"),
+                uncleanable_tracks,
+            )
+            + "\n"
         )
-        + "\n"
-    )
 
 
-def replace_with_ytmusic(args: Namespace):
-    yt_playlists = YTPlaylists()
+def replace_with_ytmusic(args: Namespace, yt_playlists: YTPlaylists | None = None):
+    yt_playlists = yt_playlists or get_yt_playlists(args)
     replaced_tracks = yt_playlists.replace_with_ytmusic(args.playlist_title)
 
-    if replaced_tracks:
+    with PROFILER.span("report"):
+        if replaced_tracks:
+            print(
+                yt_playlists.create_md_table(
+                    "Replaced YouTube tracks with YouTube Music versions",
+                    (
+                        "titleLink",
+                        "artistNames",
+                        "album",
+                        "privacyStatus",
+                        "historicalLink",
+                    ),
+                    replaced_tracks,
+                )
+                + "\n"
+            )
+            print(f"Total tracks replaced: {len(replaced_tracks)}")
+        else:
+            print("No tracks were replaced.")
+
+
+def library(args: Namespace):
+    library_index = LibraryIndex(args.library or LIBRARY_FILE)
+    with PROFILER.span("report"):
         print(
-            yt_playlists.create_md_table(
-                "Replaced YouTube tracks with YouTube Music versions",
-                (
-                    "titleLink",
-                    "artistNames",
-                    "album",
-                    "privacyStatus",
-                    "historicalLink",
-                ),
-                replaced_tracks,
+            YTPlaylists.create_md_table(
+                f"Tracks in {args.min_playlists}+ playlists",
+                ("titleLink", "artistNames", "playlistCount", "playlistTitles"),
+                [
+                    {
+                        "titleLink": video["title_link"],
+                        "artistNames": video["artist_names"],
+                        "playlistCount": str(video["playlist_count"]),
+                        "playlistTitles": video["playlist_titles"],
+                    }
+                    for video in library_index.get_tracks_in_playlists(
+                        args.min_playlists
+                    )
+                ],
+            )
+            + "\n"
+        )
+        print(
+            YTPlaylists.create_md_table(
+                "Duplicates across playlists",
+                ("sanitizedTitle", "titleLink", "artistNames", "playlistTitles"),
+                [
+                    {
+                        "sanitizedTitle": video["sanitized_title"],
+                        "titleLink": video["title_link"],
+                        "artistNames": video["artist_names"],
+                        "playlistTitles": video["playlist_titles"],
+                    }
+                    for video in library_index.get_duplicates()
+                ],
             )
             + "\n"
         )
-        print(f"Total tracks replaced: {len(replaced_tracks)}")
-    else:
-        print("No tracks were replaced.")
+
+
+def watch_playlist(
+    args: Namespace, yt_playlists: YTPlaylists, playlist_title, reported_ids
+):
+    if args.clean and playlist_title == args.clean[0]:
+        clean(
+            Namespace(
+                explicit_playlist_title=args.clean[0],
+                clean_playlist_title=args.clean[1],
+                archive_playlist_title=args.clean[2],
+            ),
+            yt_playlists,
+        )
+    if playlist_title not in args.playlist_titles:
+        return
+    if args.replace_with_ytmusic:
+        replace_with_ytmusic(Namespace(playlist_title=playlist_title), yt_playlists)
+    if args.sort:
+        sort(
+            Namespace(
+                target_playlist_title=playlist_title,
+                key="title",
+                quota_budget=QUOTA_BUDGET,
+            ),
+            yt_playlists,
+        )
+
+    # Only report problems that were not in the previous cycle
+    tracks = yt_playlists.get_tracks(playlist_title)
+    for table_name, headers, records in problem_tables(tracks, args.max_minutes):
+        previous_ids = reported_ids.get((playlist_title, table_name))
+        reported_ids[(playlist_title, table_name)] = {
+            record["videoId"] for record in records
+        }
+        if previous_ids is None:
+            table_name = f"{playlist_title}: {table_name}"
+        else:
+            table_name = f"New in {playlist_title}: {table_name}"
+            records = [
+                record for record in records if record["videoId"] not in previous_ids
+            ]
+        if records:
+            print(yt_playlists.create_md_table(table_name, headers, records) + "\n")
+
+
+def watch(args: Namespace):
+    yt_playlists = get_yt_playlists(args)
+    playlist_titles = set(args.playlist_titles)
+    if args.clean:
+        playlist_titles.add(args.clean[0])
+
+    signatures = {}
+    reported_ids = {}
+    cycle = 0
+    while True:
+        try:
+            current_signatures = yt_playlists.get_playlist_signatures(playlist_titles)
+        except Exception as e:
+            print(f"Error reading playlist signatures: {str(e)}\n")
+            stdout.flush()
+            sleep(args.interval)
+            continue
+
+        # Signatures miss videos turning private or deleted,
+        # so periodically recheck every playlist from scratch
+        cycle += 1
+        refresh = args.refresh_cycles and cycle % args.refresh_cycles == 0
+        if refresh:
+            yt_playlists.clear_caches()
+        changed_titles = [
+            playlist_title
+            for playlist_title in sorted(playlist_titles)
+            if refresh
+            or current_signatures.get(playlist_title) != signatures.get(playlist_title)
+        ]
+        print(f"## {datetime.now():%Y-%m-%d %H:%M:%S} changed: {changed_titles}\n")
+        if changed_titles:
+            # Pick up songs liked since the previous cycle
+            yt_playlists.liked_video_ids = None
+
+        failed_titles = []
+        for playlist_title in changed_titles:
+            try:
+                watch_playlist(args, yt_playlists, playlist_title, reported_ids)
+            except Exception as e:
+                failed_titles.append(playlist_title)
+                print(f"Error watching {playlist_title}: {str(e)}\n")
+
+        if changed_titles:
+            # Our own mutations change the signatures, so take them afterwards
+            try:
+                signatures = yt_playlists.get_playlist_signatures(playlist_titles)
+            except Exception as e:
+                print(f"Error reading playlist signatures: {str(e)}\n")
+                signatures = {}
+            # Retry failed playlists in the next cycle
+            for playlist_title in failed_titles:
+                signatures.pop(playlist_title, None)
+        stdout.flush()
+        sleep(args.interval)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
+    parser.add_argument("--profile", type=str, help="path of the JSON trace")
+    parser.add_argument("--cprofile", type=str, help="path of the cProfile stats")
+    parser.add_argument("--library", type=str, help="path of the library database")
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="read compare and problems tracks from the library",
+    )
+    parser.add_argument(
+        "--liked_songs",
+        action="store_true",
+        help="resolve likeStatus from the liked songs instead of getRating",
+    )
     subparsers = parser.add_subparsers()
 
     subparser = subparsers.add_parser("ytmusic_oauth")
@@ -919,6 +2140,8 @@ if __name__ == "__main__":
 
     subparser = subparsers.add_parser("sort")
     subparser.add_argument("target_playlist_title", type=str)
+    subparser.add_argument("--key", choices=SORT_KEYS, default="title")
+    subparser.add_argument("--quota_budget", type=int, default=QUOTA_BUDGET)
     subparser.set_defaults(func=sort)
 
     subparser = subparsers.add_parser("clean")
@@ -931,8 +2154,51 @@ if __name__ == "__main__":
     subparser.add_argument("playlist_title", type=str)
     subparser.set_defaults(func=replace_with_ytmusic)
 
+    subparser = subparsers.add_parser("watch")
+    subparser.add_argument("playlist_titles", type=str, nargs="+")
+    subparser.add_argument("--interval", type=int, default=300, help="seconds")
+    subparser.add_argument("--max_minutes", type=int, default=6)
+    subparser.add_argument(
+        "--refresh_cycles",
+        type=int,
+        default=12,
+        help="recheck every playlist every n cycles, 0 to disable",
+    )
+    subparser.add_argument("--sort", action="store_true")
+    subparser.add_argument("--replace_with_ytmusic", action="store_true")
+    subparser.add_argument(
+        "--clean",
+        nargs=3,
+        metavar=(
+            "explicit_playlist_title",
+            "clean_playlist_title",
+            "archive_playlist_title",
+        ),
+    )
+    subparser.set_defaults(func=watch)
+
+    subparser = subparsers.add_parser("library")
+    subparser.add_argument("--min_playlists", type=int, default=3)
+    subparser.set_defaults(func=library)
+
     args = parser.parse_args()
-    args.func(args)
+    if args.offline and args.func not in (compare, problems, library):
+        parser.error("--offline only works with compare, problems and library")
+    if args.profile:
+        PROFILER.enable()
+    profile = Profile() if args.cprofile else None
+    if profile:
+        profile.enable()
+    try:
+        with PROFILER.span(args.func.__name__):
+            args.func(args)
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(args.cprofile)
+        if args.profile:
+            PROFILER.write(args.profile)
+            print(PROFILER.md_table() + "\n")
 
 
 # TODO: add unit tests especially to make sure exceptions work